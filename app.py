@@ -1,63 +1,179 @@
 # app.py — TriageSense with multi-turn conversation support
-import os
+import json
+import asyncio
+import hashlib
+import anyio
 import sqlite3
+import aiosqlite
+import ahocorasick
+from cachetools import TTLCache
+from contextlib import asynccontextmanager
 from datetime import datetime
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
-from dotenv import load_dotenv
-from openai import OpenAI
+from pathlib import Path
+from fastapi import FastAPI, HTTPException, Query, Request, Response
+from typing import List, Optional
+from pydantic import BaseModel, Field
+from pydantic_settings import BaseSettings, SettingsConfigDict
+from openai import AsyncOpenAI, APIConnectionError, RateLimitError, InternalServerError
+from aiolimiter import AsyncLimiter
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_random_exponential
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from schema import SUBMISSIONS_ADDED_COLUMNS
 
-# Load .env
-load_dotenv()
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-if not OPENAI_API_KEY:
-    raise RuntimeError(
-        "OPENAI_API_KEY not set. Put your key in the .env file or export it in the environment.")
 
-# OpenAI client
-client = OpenAI(api_key=OPENAI_API_KEY)
+# Config from the environment / .env
+class Settings(BaseSettings):
+    """Resolved once at import from the environment or .env; raises if OPENAI_API_KEY is missing."""
+    model_config = SettingsConfigDict(env_file=".env", extra="ignore", frozen=True)
 
-app = FastAPI(title="TriageSense API")
+    openai_api_key: str = Field(min_length=1)
+    openai_rpm: int = 3500
+    # the SDK read these from os.environ; .env is no longer loaded into it, so map them here
+    openai_base_url: Optional[str] = None
+    openai_org_id: Optional[str] = None
+    openai_project_id: Optional[str] = None
+
+
+settings = Settings()
+
+# OpenAI client (async, so a slow completion doesn't block the event loop).
+# SDK retries are disabled; chat_completion() below owns pacing and retries.
+client = AsyncOpenAI(
+    api_key=settings.openai_api_key,
+    base_url=settings.openai_base_url,
+    organization=settings.openai_org_id,
+    project=settings.openai_project_id,
+    max_retries=0,
+)
+OPENAI_TIMEOUT = 30  # seconds per call including retries; for a streamed /triage reply, open to last chunk
+
+# Per-worker request pacing so bursts queue instead of tripping 429s
+openai_limiter = AsyncLimiter(settings.openai_rpm, 60)
+
+_backoff = wait_random_exponential(min=1, max=8)
+
+
+def _retry_after_or_backoff(retry_state):
+    """Honour the server's Retry-After header when present, else exponential backoff."""
+    response = getattr(retry_state.outcome.exception(), "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    try:
+        return min(float(retry_after), 8)
+    except (TypeError, ValueError):
+        return _backoff(retry_state)
+
+
+@retry(wait=_retry_after_or_backoff, stop=stop_after_attempt(5), reraise=True,
+       # APIConnectionError also covers APITimeoutError; these replace the SDK's own retries
+       retry=retry_if_exception_type((RateLimitError, InternalServerError, APIConnectionError)))
+async def chat_completion(messages, **kwargs):
+    async with openai_limiter:
+        return await client.chat.completions.create(model="gpt-4o-mini", messages=messages, **kwargs)
+
+app = FastAPI(title="TriageSense API", default_response_class=ORJSONResponse)
 
 # Mount static directory to serve the frontend
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
-# Serve index.html at site root
+# Serve index.html at site root from memory; browsers revalidate with the ETag after max-age
+INDEX_BYTES = Path("static/index.html").read_bytes()
+INDEX_ETAG = '"' + hashlib.md5(INDEX_BYTES, usedforsecurity=False).hexdigest() + '"'
+INDEX_HEADERS = {"ETag": INDEX_ETAG, "Cache-Control": "public, max-age=3600"}
 
 
 @app.get("/", include_in_schema=False)
-def root():
-    return FileResponse("static/index.html")
+async def root(request: Request):
+    if_none_match = request.headers.get("if-none-match", "")
+    if INDEX_ETAG in (tag.strip().removeprefix("W/") for tag in if_none_match.split(",")):
+        return Response(status_code=304, headers=INDEX_HEADERS)
+    return Response(INDEX_BYTES, media_type="text/html", headers=INDEX_HEADERS)
 
 
 # --------------- Database ----------------
 DB_PATH = "triagesense.db"
 
 
-def get_db_conn():
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-    conn.row_factory = sqlite3.Row
-    return conn
+# WAL lets readers proceed while a write is in flight; NORMAL sync is safe under WAL
+DB_PRAGMAS = [
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-64000",
+    "PRAGMA temp_store=MEMORY",
+    # messages.submission_id must point at a real submission (lets /converse skip a lookup)
+    "PRAGMA foreign_keys=ON",
+]
+
+# Hoisted so sqlite3's statement cache reuses the prepared statements across requests
+SQL_INSERT_SUBMISSION = "INSERT INTO submissions (symptoms, reply, triage_level, triage_reason, created_at) VALUES (?, ?, ?, ?, ?)"
+SQL_UPDATE_REPLY = "UPDATE submissions SET reply = ? WHERE id = ?"
+SQL_DELETE_SUBMISSION = "DELETE FROM submissions WHERE id = ?"
+SQL_DELETE_MESSAGES = "DELETE FROM messages WHERE submission_id = ?"
+SQL_INSERT_MSG = "INSERT INTO messages (submission_id, role, content, created_at) VALUES (?, ?, ?, ?)"
+SQL_SELECT_HISTORY = "SELECT role, content FROM messages WHERE submission_id = ? ORDER BY id DESC LIMIT ?"
+# NULL: no such submission; 0: /triage placeholder whose reply is still streaming
+SQL_SUBMISSION_READY = "SELECT reply != '' FROM submissions WHERE id = ?"
+SQL_SELECT_PINNED = "SELECT symptoms, reply, summary FROM submissions WHERE id = ?"
+SQL_SELECT_CONVERSATION = "SELECT id, role, content, created_at FROM messages WHERE submission_id = ? ORDER BY id ASC"
+
+THREADPOOL_SIZE = 100
+
+
+def get_db():
+    """Shared aiosqlite connection opened at startup."""
+    return app.state.db
+
+
+@asynccontextmanager
+async def db_write():
+    """One write transaction on the shared connection: holds the write lock (SQLite still
+    serializes writers), commits on success and rolls back on any error or cancellation,
+    so a failed write never leaks into the next request's commit."""
+    db = get_db()
+    async with app.state.db_write_lock:
+        try:
+            yield db
+            await db.commit()
+        except BaseException:
+            await db.rollback()
+            raise
+
+
+async def init_db(db):
+    # Every worker runs this at startup; BEGIN IMMEDIATE takes the write lock up front so
+    # concurrent workers apply the schema one at a time (no duplicate-column ALTERs)
+    await db.execute("BEGIN IMMEDIATE")
+    try:
+        await _apply_schema(db)
+        await db.commit()
+    except BaseException:
+        await db.rollback()
+        raise
 
 
-def init_db():
-    conn = get_db_conn()
-    cur = conn.cursor()
+async def _apply_schema(db):
     # submissions table (existing)
-    cur.execute("""
+    await db.execute("""
     CREATE TABLE IF NOT EXISTS submissions (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         symptoms TEXT NOT NULL,
         reply TEXT NOT NULL,
         triage_level TEXT,
         triage_reason TEXT,
-        created_at TEXT NOT NULL
+        created_at TEXT NOT NULL,
+        summary TEXT, -- rolling summary of turns that fell out of the /converse window
+        summarized_through INTEGER -- last messages.id folded into summary
     )
     """)
+    # Databases created before a column existed get it added here, so the app doesn't
+    # depend on migrate_db.py having been run
+    async with db.execute("PRAGMA table_info(submissions)") as cur:
+        cols = {r["name"] for r in await cur.fetchall()}
+    for name, col_type in SUBMISSIONS_ADDED_COLUMNS:
+        if name not in cols:
+            await db.execute(f"ALTER TABLE submissions ADD COLUMN {name} {col_type}")
     # messages table for multi-turn conversation
-    cur.execute("""
+    await db.execute("""
     CREATE TABLE IF NOT EXISTS messages (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         submission_id INTEGER NOT NULL,
@@ -67,13 +183,33 @@ def init_db():
         FOREIGN KEY(submission_id) REFERENCES submissions(id)
     )
     """)
-    conn.commit()
-    conn.close()
+    # /converse reads history per submission in id order; make that an index range scan
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_messages_submission_id ON messages(submission_id, id)")
+    # lets the reply cache find earlier identical statements without a table scan
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_submissions_symptoms ON submissions(symptoms COLLATE NOCASE)")
 
 
 @app.on_event("startup")
-def startup_event():
-    init_db()
+async def startup_event():
+    # sqlite3's timeout is the busy handler: with several Uvicorn workers, writers in other
+    # processes wait up to 5s for the lock instead of failing with SQLITE_BUSY
+    db = await aiosqlite.connect(DB_PATH, timeout=5.0)
+    db.row_factory = aiosqlite.Row
+    for pragma in DB_PRAGMAS:
+        await db.execute(pragma)
+    await init_db(db)
+    app.state.db = db
+    app.state.db_write_lock = asyncio.Lock()
+    # StaticFiles reads /static/* files on anyio's threadpool; the default 40 slots
+    # can all be held by slow clients and stall every other static request
+    anyio.to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await app.state.db.close()
 
 
 # --------------- Prompt / AI config ----------------
@@ -104,6 +240,11 @@ USER_TEMPLATE = (
     "End with one line: _This information is educational and not a substitute for medical assessment._"
 )
 
+# Built once at import: requests only concatenate around the symptoms and reuse the system message.
+# SYSTEM_MESSAGE is shared across requests, so never mutate it.
+SYSTEM_MESSAGE = {"role": "system", "content": SYSTEM_INSTRUCTION}
+USER_TEMPLATE_PREFIX, USER_TEMPLATE_SUFFIX = USER_TEMPLATE.split("{symptoms}")
+
 # --------------- Simple triage classifier ----------------
 EMERGENCY_KEYWORDS = [
     "chest pain", "not breathing", "severe shortness", "shortness of breath",
@@ -118,21 +259,140 @@ URGENT_KEYWORDS = [
 ]
 
 
+MILD_INDICATORS = [
+    "runny nose", "mild sore", "mild cough", "sore throat", "sneezing", "congestion", "nasal",
+    "itchy eyes", "minor headache", "slight cough", "low-grade fever", "1 day", "2 days"
+]
+
+# Words that rule out self-care even when mild indicators are present
+MILD_EXCLUSIONS = ["severe", "worsen", "persistent"]
+
+# Severity ranks used by the automaton; lower wins
+EMERGENCY, URGENT, MILD, EXCLUDE = range(4)
+
+
+def _build_keyword_automaton():
+    """Compile every keyword list into one Aho-Corasick automaton so a single pass finds all hits."""
+    automaton = ahocorasick.Automaton()
+    tags = {}
+    for severity, keywords in ((EMERGENCY, EMERGENCY_KEYWORDS), (URGENT, URGENT_KEYWORDS),
+                               (MILD, MILD_INDICATORS), (EXCLUDE, MILD_EXCLUSIONS)):
+        for order, k in enumerate(keywords):
+            tags.setdefault(k, []).append((severity, order, k))
+    for k, hits in tags.items():
+        automaton.add_word(k, hits)
+    automaton.make_automaton()
+    return automaton
+
+
+KEYWORD_AUTOMATON = _build_keyword_automaton()
+
+
 def determine_triage_level(symptoms_text: str) -> (str, str):
     text = (symptoms_text or "").lower()
-    for k in EMERGENCY_KEYWORDS:
-        if k in text:
-            return "Emergency", f"Contains emergency sign/keyword: '{k}'. Immediate evaluation recommended."
-    for k in URGENT_KEYWORDS:
-        if k in text:
-            return "Urgent", f"Contains concerning feature: '{k}', consider urgent assessment."
-    mild_indicators = ["runny nose", "mild sore", "mild cough", "sore throat", "sneezing", "congestion", "nasal",
-                       "itchy eyes", "minor headache", "slight cough", "low-grade fever", "1 day", "2 days"]
-    mild_count = sum(1 for k in mild_indicators if k in text)
-    if mild_count >= 1 and "severe" not in text and "worsen" not in text and "persistent" not in text:
+    # Keep the earliest-listed keyword per severity so reasons match the list order
+    best = {}
+    for _, hits in KEYWORD_AUTOMATON.iter(text):
+        for severity, order, k in hits:
+            if severity not in best or order < best[severity][0]:
+                best[severity] = (order, k)
+    if EMERGENCY in best:
+        k = best[EMERGENCY][1]
+        return "Emergency", f"Contains emergency sign/keyword: '{k}'. Immediate evaluation recommended."
+    if URGENT in best:
+        k = best[URGENT][1]
+        return "Urgent", f"Contains concerning feature: '{k}', consider urgent assessment."
+    if MILD in best and EXCLUDE not in best:
         return "Self-care", "Symptoms appear mild; self-care and watchful waiting may be appropriate."
     return "Non-urgent", "No immediate warning signs detected; consider primary care or self-care as appropriate."
 
+# --------------- Conversation window ----------------
+# /converse only resends the last few turns so per-turn input tokens stay bounded;
+# older turns are folded into submissions.summary in the background.
+CONVERSE_HISTORY_WINDOW = 8
+
+SUMMARY_INSTRUCTION = (
+    "You maintain a running clinical summary of a triage conversation. "
+    "Merge the previous summary with the new turns into at most 6 short bullet points. "
+    "Keep symptoms, timelines, relevant history, and advice already given. Omit pleasantries."
+)
+
+# Keep a reference to background tasks so they aren't garbage-collected mid-flight
+_background_tasks = set()
+
+
+def run_in_background(coro):
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+async def summarize_older_turns(submission_id: int):
+    """Fold messages that dropped out of the window into the submission's rolling summary."""
+    db = get_db()
+    try:
+        async with db.execute("SELECT summary, summarized_through FROM submissions WHERE id = ?",
+                              (submission_id,)) as cur:
+            row = await cur.fetchone()
+        if not row:
+            return
+        through = row["summarized_through"] or 0
+        async with db.execute(
+                "SELECT id, role, content FROM messages WHERE submission_id = ? AND id > ? AND id < "
+                "(SELECT MIN(id) FROM (SELECT id FROM messages WHERE submission_id = ? ORDER BY id DESC LIMIT ?)) "
+                "ORDER BY id ASC",
+                (submission_id, through, submission_id, CONVERSE_HISTORY_WINDOW - 1)) as cur:
+            dropped = await cur.fetchall()
+        if not dropped:
+            return
+
+        turns = "\n\n".join(f"{r['role']}: {r['content']}" for r in dropped)
+        response = await asyncio.wait_for(
+            chat_completion(
+                [
+                    {"role": "system", "content": SUMMARY_INSTRUCTION},
+                    {"role": "user", "content": f"Previous summary:\n{row['summary'] or '(none)'}\n\nNew turns:\n{turns}"}
+                ],
+                max_tokens=250,
+                temperature=0.1
+            ),
+            timeout=OPENAI_TIMEOUT
+        )
+        summary = response.choices[0].message.content
+
+        async with db_write():
+            # Skip the update if a concurrent turn already advanced the summary
+            await db.execute(
+                "UPDATE submissions SET summary = ?, summarized_through = ? WHERE id = ? AND IFNULL(summarized_through, 0) = ?",
+                (summary, dropped[-1]["id"], submission_id, through)
+            )
+    except Exception as e:
+        print("Summary update error:", e)
+
+# --------------- Reply cache ----------------
+# Identical symptom statements reuse an earlier reply instead of another OpenAI round-trip.
+# L1 is this process's TTL cache; L2 is the submissions table, so hits survive restarts.
+REPLY_CACHE = TTLCache(maxsize=1024, ttl=3600)
+
+
+def reply_cache_key(symptoms_text: str) -> str:
+    return hashlib.sha1(symptoms_text.lower().strip().encode("utf-8")).hexdigest()
+
+
+async def lookup_cached_reply(symptoms_text: str):
+    key = reply_cache_key(symptoms_text)
+    cached = REPLY_CACHE.get(key)
+    if cached is not None:
+        return cached
+    async with get_db().execute(
+            "SELECT reply FROM submissions WHERE symptoms = ? COLLATE NOCASE AND reply != '' ORDER BY id DESC LIMIT 1", (symptoms_text,)) as cur:
+        row = await cur.fetchone()
+    if row:
+        REPLY_CACHE[key] = row["reply"]
+        return row["reply"]
+    return None
+
 # ----------------- Models -----------------
 
 
@@ -147,113 +407,345 @@ class ConverseIn(BaseModel):
 # ----------------- Endpoints -----------------
 
 
+def sse_event(data: dict, event: str = None) -> str:
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data)}\n\n"
+
+
+async def create_submission(symptoms_text: str, triage_level: str, triage_reason: str, created_at: str) -> int:
+    """Insert the submission before its reply is known so the id can be streamed first."""
+    async with db_write() as db:
+        async with db.execute(
+            SQL_INSERT_SUBMISSION,
+            (symptoms_text, "", triage_level,
+             triage_reason, created_at)
+        ) as cur:
+            submission_id = cur.lastrowid
+    return submission_id
+
+
+async def save_triage_reply(submission_id: int, content: str, created_at: str):
+    async with db_write() as db:
+        await db.execute(SQL_UPDATE_REPLY, (content, submission_id))
+        # Save initial assistant message as a messages row (so conversation history starts)
+        await db.execute(
+            SQL_INSERT_MSG,
+            (submission_id, "assistant", content, created_at)
+        )
+
+
+async def close_stream(stream):
+    try:
+        await stream.close()
+    except Exception as e:
+        print("OpenAI stream close error:", e)
+
+
+async def abandon_triage(openai_task, submission_task):
+    """Clean up after a /triage request cancelled mid-setup: close the stream if it opened
+    and drop the placeholder row once its insert settles."""
+    for task, cleanup in ((openai_task, close_stream), (submission_task, discard_submission)):
+        try:
+            result = await task
+        except BaseException:
+            continue
+        await cleanup(result)
+
+
+async def discard_submission(submission_id: int):
+    try:
+        async with db_write() as db:
+            # children first, or the foreign key blocks the delete
+            await db.execute(SQL_DELETE_MESSAGES, (submission_id,))
+            await db.execute(SQL_DELETE_SUBMISSION, (submission_id,))
+    except Exception as e:
+        print("DB delete error:", e)
+
+
 @app.post("/triage")
 async def triage(input: SymptomsIn):
+    """Stream the triage note as server-sent events: a `meta` event with the submission id and
+    triage level, one data event per reply delta, then `done` once the reply is saved."""
     symptoms_text = input.symptoms.strip()
     if not symptoms_text:
         raise HTTPException(
             status_code=400, detail="symptoms must be provided")
-
-    messages = [
-        {"role": "system", "content": SYSTEM_INSTRUCTION},
-        {"role": "user", "content": USER_TEMPLATE.format(
-            symptoms=symptoms_text)}
-    ]
+    # One timestamp per request, shared by every row it writes
+    now = datetime.utcnow().isoformat()
 
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=messages,
-            max_tokens=800,
-            temperature=0.18
-        )
+        cached = await lookup_cached_reply(symptoms_text)
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"OpenAI API error: {e}")
-
-    # Extract assistant reply
-    try:
-        content = response.choices[0].message["content"]
-    except Exception:
-        content = getattr(
-            response.choices[0].message, "content", str(response))
-
-    triage_level, triage_reason = determine_triage_level(symptoms_text)
-
-    # Save submission
+        print("Reply cache lookup error:", e)
+        cached = None
+
+    stream = None
+    if cached is None:
+        messages = [
+            SYSTEM_MESSAGE,
+            {"role": "user", "content": USER_TEMPLATE_PREFIX + symptoms_text + USER_TEMPLATE_SUFFIX}
+        ]
+        # wait_for below only covers opening the stream; reading it is bounded by the same deadline
+        deadline = asyncio.get_running_loop().time() + OPENAI_TIMEOUT
+        openai_task = asyncio.create_task(asyncio.wait_for(
+            chat_completion(
+                messages,
+                max_tokens=800,
+                temperature=0.18,
+                stream=True
+            ),
+            timeout=OPENAI_TIMEOUT
+        ))
+        # Yield once so the task starts (limiter acquire, connection setup) before the
+        # local work below; the request itself goes out on a later loop iteration
+        await asyncio.sleep(0)
+        triage_level, triage_reason = determine_triage_level(symptoms_text)
+        # Save the submission row while the request is in flight; further pre-checks
+        # (moderation, embedding lookups) belong in this gather too
+        submission_task = asyncio.create_task(
+            create_submission(symptoms_text, triage_level, triage_reason, now))
+        try:
+            # shielded so a cancelled request still learns the row id and can discard it
+            stream, submission_id = await asyncio.gather(
+                openai_task, asyncio.shield(submission_task), return_exceptions=True)
+        except asyncio.CancelledError:
+            openai_task.cancel()
+            run_in_background(abandon_triage(openai_task, submission_task))
+            raise
+        if isinstance(submission_id, Exception):
+            print("DB save error:", submission_id)
+            submission_id = None
+        if isinstance(stream, Exception):
+            if submission_id is not None:
+                await discard_submission(submission_id)
+            if isinstance(stream, asyncio.TimeoutError):
+                raise HTTPException(status_code=504, detail="OpenAI API timed out")
+            if isinstance(stream, RateLimitError):
+                raise HTTPException(status_code=503, detail="OpenAI rate limit reached, please retry shortly")
+            raise HTTPException(status_code=500, detail=f"OpenAI API error: {stream}")
+    else:
+        triage_level, triage_reason = determine_triage_level(symptoms_text)
+        try:
+            submission_id = await create_submission(symptoms_text, triage_level, triage_reason, now)
+        except Exception as e:
+            print("DB save error:", e)
+            submission_id = None
+
+    async def event_stream():
+        # Until the full reply is saved, the submission is only a placeholder; any early
+        # exit (stream error, client disconnect/cancellation) discards it in the finally below
+        saved = False
+        try:
+            yield sse_event({"submission_id": submission_id, "triage_level": triage_level,
+                             "triage_reason": triage_reason}, "meta")
+            if stream is None:
+                content = cached
+                yield sse_event({"delta": content})
+            else:
+                parts = []
+                loop = asyncio.get_running_loop()
+                chunks = stream.__aiter__()
+                try:
+                    # Each read gets the time left until the deadline. A timeout around the whole
+                    # loop would also cancel whatever the consumer is awaiting while we are suspended at a yield
+                    while True:
+                        try:
+                            chunk = await asyncio.wait_for(
+                                chunks.__anext__(), timeout=max(deadline - loop.time(), 0))
+                        except StopAsyncIteration:
+                            break
+                        delta = chunk.choices[0].delta.content if chunk.choices else None
+                        if delta:
+                            parts.append(delta)
+                            yield sse_event({"delta": delta})
+                except asyncio.TimeoutError:
+                    yield sse_event({"detail": "OpenAI API timed out"}, "error")
+                    return
+                except Exception as e:
+                    yield sse_event({"detail": f"OpenAI API error: {e}"}, "error")
+                    return
+                content = "".join(parts)
+                # an empty reply must not be served to later identical statements
+                if content:
+                    REPLY_CACHE[reply_cache_key(symptoms_text)] = content
+
+            if submission_id is not None:
+                try:
+                    await save_triage_reply(submission_id, content, now)
+                    saved = True
+                except Exception as e:
+                    print("DB save error:", e)
+            yield sse_event({}, "done")
+        finally:
+            # shielded: on disconnect Starlette cancels this scope, which would abort the cleanup awaits
+            with anyio.CancelScope(shield=True):
+                if stream is not None:
+                    await close_stream(stream)
+                if submission_id is not None and not saved:
+                    await discard_submission(submission_id)
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+BATCH_MAX_ITEMS = 32
+BATCH_CONCURRENCY = 8
+
+
+@app.post("/triage/batch")
+async def triage_batch(items: List[SymptomsIn]):
+    """Triage many statements at once (offline/dashboard use); not streamed.
+    Results keep the input order; an item whose OpenAI call fails carries an `error` instead."""
+    if not items:
+        raise HTTPException(status_code=400, detail="at least one item must be provided")
+    if len(items) > BATCH_MAX_ITEMS:
+        raise HTTPException(
+            status_code=400, detail=f"at most {BATCH_MAX_ITEMS} items per batch")
+    texts = [item.symptoms.strip() for item in items]
+    if not all(texts):
+        raise HTTPException(
+            status_code=400, detail="symptoms must be provided for every item")
+    now = datetime.utcnow().isoformat()
+
+    sem = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    async def one(symptoms_text):
+        try:
+            cached = await lookup_cached_reply(symptoms_text)
+        except Exception as e:
+            print("Reply cache lookup error:", e)
+            cached = None
+        if cached is not None:
+            return cached
+        async with sem:
+            response = await asyncio.wait_for(
+                chat_completion(
+                    [SYSTEM_MESSAGE,
+                     {"role": "user", "content": USER_TEMPLATE_PREFIX + symptoms_text + USER_TEMPLATE_SUFFIX}],
+                    max_tokens=800,
+                    temperature=0.18
+                ),
+                timeout=OPENAI_TIMEOUT
+            )
+        try:
+            content = response.choices[0].message["content"]
+        except Exception:
+            content = getattr(
+                response.choices[0].message, "content", str(response))
+        if content:
+            REPLY_CACHE[reply_cache_key(symptoms_text)] = content
+        return content
+
+    # Repeated statements within the batch share one call
+    unique = {}
+    for symptoms_text in texts:
+        unique.setdefault(reply_cache_key(symptoms_text), symptoms_text)
+    replies = dict(zip(unique, await asyncio.gather(
+        *[one(t) for t in unique.values()], return_exceptions=True)))
+
+    results = []
+    for symptoms_text in texts:
+        content = replies[reply_cache_key(symptoms_text)]
+        if isinstance(content, Exception):
+            detail = "OpenAI API timed out" if isinstance(content, asyncio.TimeoutError) else f"OpenAI API error: {content}"
+            results.append({"submission_id": None, "error": detail})
+            continue
+        triage_level, triage_reason = determine_triage_level(symptoms_text)
+        results.append({"submission_id": None, "symptoms": symptoms_text, "triage_reply": content,
+                        "triage_level": triage_level, "triage_reason": triage_reason})
+
+    # Save every successful item in one transaction
+    saved = [r for r in results if "error" not in r]
     try:
-        conn = get_db_conn()
-        cur = conn.cursor()
-        cur.execute(
-            "INSERT INTO submissions (symptoms, reply, triage_level, triage_reason, created_at) VALUES (?, ?, ?, ?, ?)",
-            (symptoms_text, content, triage_level,
-             triage_reason, datetime.utcnow().isoformat())
-        )
-        submission_id = cur.lastrowid
-        # Save initial assistant message as a messages row (so conversation history starts)
-        cur.execute(
-            "INSERT INTO messages (submission_id, role, content, created_at) VALUES (?, ?, ?, ?)",
-            (submission_id, "assistant", content, datetime.utcnow().isoformat())
-        )
-        conn.commit()
-        conn.close()
+        async with db_write() as db:
+            for r in saved:
+                async with db.execute(
+                    SQL_INSERT_SUBMISSION,
+                    (r["symptoms"], r["triage_reply"], r["triage_level"], r["triage_reason"], now)
+                ) as cur:
+                    r["submission_id"] = cur.lastrowid
+            await db.executemany(
+                SQL_INSERT_MSG,
+                [(r["submission_id"], "assistant", r["triage_reply"], now) for r in saved])
     except Exception as e:
-        print("DB save error:", e)
+        for r in saved:
+            r["submission_id"] = None
+        print("DB save error (batch):", e)
 
-    return {"submission_id": submission_id, "triage_reply": content, "triage_level": triage_level, "triage_reason": triage_reason}
+    for r in saved:
+        del r["symptoms"]
+    return {"results": results}
 
 
 @app.post("/converse")
 async def converse(input: ConverseIn):
-    # Validate submission exists
-    conn = get_db_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT id, symptoms, reply FROM submissions WHERE id = ?",
-                (input.submission_id,))
-    row = cur.fetchone()
-    if not row:
-        conn.close()
-        raise HTTPException(status_code=404, detail="Submission not found")
+    db = get_db()
 
-    # Save the incoming user message to messages table
+    # The user message is saved together with the reply below, in one transaction
     user_msg = input.message.strip()
     if not user_msg:
-        conn.close()
         raise HTTPException(status_code=400, detail="message must be provided")
-
+    # One timestamp per request, shared by both rows it writes
+    now = datetime.utcnow().isoformat()
+
+    # Reconstruct conversation history: system instruction, the last stored messages, then the new user message
+    # (CONVERSE_HISTORY_WINDOW in total). One extra row is fetched to tell whether older turns were dropped.
+    stored_window = CONVERSE_HISTORY_WINDOW - 1
+    # Stored messages imply the submission exists (foreign key), so the separate
+    # existence/readiness check is only needed when there is no history yet
     try:
-        cur.execute(
-            "INSERT INTO messages (submission_id, role, content, created_at) VALUES (?, ?, ?, ?)",
-            (input.submission_id, "user", user_msg, datetime.utcnow().isoformat())
-        )
-        conn.commit()
+        async with db.execute(SQL_SELECT_HISTORY, (input.submission_id, stored_window + 1)) as cur:
+            rows = list(reversed(await cur.fetchall()))
+        # messages are only written once the triage reply is saved, so any history means it is ready
+        ready = 1 if rows else None
+        if not rows:
+            async with db.execute(SQL_SUBMISSION_READY, (input.submission_id,)) as cur:
+                status = await cur.fetchone()
+            ready = status[0] if status else None
     except Exception as e:
-        conn.close()
-        raise HTTPException(status_code=500, detail=f"DB save error: {e}")
+        raise HTTPException(status_code=500, detail=f"DB read error: {e}")
+    if ready is None:
+        raise HTTPException(status_code=404, detail="Submission not found")
+    if not ready:
+        raise HTTPException(status_code=409, detail="Triage reply is still being generated")
 
-    # Reconstruct conversation history: system instruction, then all messages for this submission (ordered)
     try:
-        cur.execute(
-            "SELECT role, content FROM messages WHERE submission_id = ? ORDER BY id ASC", (input.submission_id,))
-        rows = cur.fetchall()
-        messages = [{"role": "system", "content": SYSTEM_INSTRUCTION}]
+        # the two rows saved this turn push the oldest ones out of the next turn's window
+        window_full = len(rows) + 2 > stored_window
+        truncated = len(rows) > stored_window
+        messages = [SYSTEM_MESSAGE]
+        if truncated:
+            rows = rows[1:]
+            # Pin the original statement and triage note, plus the summary of what's in between
+            async with db.execute(SQL_SELECT_PINNED, (input.submission_id,)) as cur:
+                row = await cur.fetchone()
+            messages.append({"role": "user", "content": row["symptoms"]})
+            messages.append({"role": "assistant", "content": row["reply"]})
+            if row["summary"]:
+                messages.append({"role": "system", "content": "Summary of earlier conversation:\n" + row["summary"]})
         for r in rows:
             # Chat API expects roles 'user' or 'assistant'
             role = r["role"]
             messages.append({"role": role, "content": r["content"]})
+        messages.append({"role": "user", "content": user_msg})
     except Exception as e:
-        conn.close()
         raise HTTPException(status_code=500, detail=f"DB read error: {e}")
 
     # Call the model with the conversation history
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=messages,
-            max_tokens=600,
-            temperature=0.18
+        response = await asyncio.wait_for(
+            chat_completion(
+                messages,
+                max_tokens=600,
+                temperature=0.18
+            ),
+            timeout=OPENAI_TIMEOUT
         )
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="OpenAI API timed out")
+    except RateLimitError:
+        raise HTTPException(status_code=503, detail="OpenAI rate limit reached, please retry shortly")
     except Exception as e:
-        conn.close()
         raise HTTPException(status_code=500, detail=f"OpenAI API error: {e}")
 
     # Extract assistant reply and save it
@@ -264,51 +756,73 @@ async def converse(input: ConverseIn):
             response.choices[0].message, "content", str(response))
 
     try:
-        cur.execute(
-            "INSERT INTO messages (submission_id, role, content, created_at) VALUES (?, ?, ?, ?)",
-            (input.submission_id, "assistant",
-             assistant_content, datetime.utcnow().isoformat())
-        )
-        conn.commit()
+        async with db_write():
+            await db.executemany(SQL_INSERT_MSG, [
+                (input.submission_id, "user", user_msg, now),
+                (input.submission_id, "assistant", assistant_content, now)
+            ])
+    except sqlite3.IntegrityError:
+        # the submission was removed while the reply was generated
+        raise HTTPException(status_code=404, detail="Submission not found")
     except Exception as e:
         # still return assistant reply even if saving fails
-        print("DB save error (assistant):", e)
+        print("DB save error (converse):", e)
+    else:
+        if window_full:
+            run_in_background(summarize_older_turns(input.submission_id))
 
     # Fetch latest conversation rows to return
     try:
-        cur.execute(
-            "SELECT id, role, content, created_at FROM messages WHERE submission_id = ? ORDER BY id ASC", (input.submission_id,))
-        conv_rows = cur.fetchall()
+        async with db.execute(SQL_SELECT_CONVERSATION, (input.submission_id,)) as cur:
+            conv_rows = await cur.fetchall()
         conv = [{"id": r["id"], "role": r["role"], "content": r["content"],
                  "created_at": r["created_at"]} for r in conv_rows]
     except Exception as e:
-        conn.close()
         raise HTTPException(
             status_code=500, detail=f"DB read error after save: {e}")
 
-    conn.close()
     return {"assistant_reply": assistant_content, "conversation": conv}
 
 
 @app.get("/submissions")
-def list_submissions(limit: int = 50):
+async def list_submissions(limit: int = Query(50, ge=1, le=200), before_id: Optional[int] = None):
+    """List submissions newest first without the full replies; page with `before_id=next_before_id`."""
     try:
-        conn = get_db_conn()
-        cur = conn.cursor()
-        cur.execute(
-            "SELECT id, symptoms, reply, triage_level, triage_reason, created_at FROM submissions ORDER BY id DESC LIMIT ?", (limit,))
-        rows = cur.fetchall()
-        conn.close()
+        async with get_db().execute(
+                "SELECT id, substr(symptoms, 1, 200) AS symptoms, triage_level, triage_reason, created_at FROM submissions "
+                "WHERE (? IS NULL OR id < ?) ORDER BY id DESC LIMIT ?", (before_id, before_id, limit)) as cur:
+            rows = await cur.fetchall()
         results = []
         for r in rows:
             results.append({
                 "id": r["id"],
                 "symptoms": r["symptoms"],
-                "reply": r["reply"],
                 "triage_level": r["triage_level"],
                 "triage_reason": r["triage_reason"],
                 "created_at": r["created_at"]
             })
-        return JSONResponse(content={"submissions": results})
+        next_before_id = results[-1]["id"] if len(results) == limit else None
+        return ORJSONResponse(content={"submissions": results, "next_before_id": next_before_id})
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"DB read error: {e}")
+
+
+@app.get("/submissions/{submission_id}")
+async def get_submission(submission_id: int):
+    try:
+        async with get_db().execute(
+                "SELECT id, symptoms, reply, triage_level, triage_reason, created_at FROM submissions WHERE id = ?",
+                (submission_id,)) as cur:
+            r = await cur.fetchone()
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"DB read error: {e}")
+    if not r:
+        raise HTTPException(status_code=404, detail="Submission not found")
+    return {
+        "id": r["id"],
+        "symptoms": r["symptoms"],
+        "reply": r["reply"],
+        "triage_level": r["triage_level"],
+        "triage_reason": r["triage_reason"],
+        "created_at": r["created_at"]
+    }
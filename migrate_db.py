@@ -1,27 +1,30 @@
 ﻿import sqlite3
+from schema import SUBMISSIONS_ADDED_COLUMNS
 DB_PATH = 'triagesense.db'
-conn = sqlite3.connect(DB_PATH)
+# The app applies the same columns itself at startup (init_db); this script is for
+# migrating a database offline without starting the server.
+# autocommit mode so the explicit BEGIN/COMMIT below wrap every ALTER in one transaction
+conn = sqlite3.connect(DB_PATH, isolation_level=None)
 cur = conn.cursor()
 
-# Inspect existing columns
-cur.execute("PRAGMA table_info(submissions)")
-cols = [r[1] for r in cur.fetchall()]
-print('Existing columns in submissions:', cols)
+# IMMEDIATE takes the write lock before reading the schema, so a running app can't race the ALTERs
+cur.execute("BEGIN IMMEDIATE")
+try:
+    # Inspect existing columns (single PRAGMA scan)
+    cur.execute("PRAGMA table_info(submissions)")
+    cols = {r[1] for r in cur.fetchall()}
+    print('Existing columns in submissions:', sorted(cols))
 
-# Add triage_level if missing
-if 'triage_level' not in cols:
-    print('Adding triage_level column...')
-    cur.execute("ALTER TABLE submissions ADD COLUMN triage_level TEXT")
-else:
-    print('triage_level column already exists.')
-
-# Add triage_reason if missing
-if 'triage_reason' not in cols:
-    print('Adding triage_reason column...')
-    cur.execute("ALTER TABLE submissions ADD COLUMN triage_reason TEXT")
-else:
-    print('triage_reason column already exists.')
-
-conn.commit()
-conn.close()
+    for name, col_type in SUBMISSIONS_ADDED_COLUMNS:
+        if name not in cols:
+            print(f'Adding {name} column...')
+            cur.execute(f"ALTER TABLE submissions ADD COLUMN {name} {col_type}")
+        else:
+            print(f'{name} column already exists.')
+    cur.execute("COMMIT")
+except Exception:
+    cur.execute("ROLLBACK")
+    raise
+finally:
+    conn.close()
 print('Migration complete.')
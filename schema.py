@@ -0,0 +1,8 @@
+# schema.py — columns added to submissions after the first release.
+# Shared by app.py (added at startup) and migrate_db.py so the two can't drift.
+SUBMISSIONS_ADDED_COLUMNS = [
+    ("triage_level", "TEXT"),
+    ("triage_reason", "TEXT"),
+    ("summary", "TEXT"),  # rolling /converse summary
+    ("summarized_through", "INTEGER"),
+]
@@ -13,5 +13,14 @@ except Exception:
 
 # Use uvicorn programmatically (will use installed uvicorn)
 import uvicorn
-print(f"Starting Uvicorn on 0.0.0.0:{PORT}")
-uvicorn.run("app:app", host="0.0.0.0", port=PORT, log_level="info")
+workers_env = os.environ.get("WEB_CONCURRENCY")
+try:
+    WORKERS = int(workers_env) if workers_env and workers_env.strip() != "" else 2
+except Exception:
+    WORKERS = 2
+
+# "auto" picks uvloop/httptools when installed (they are in requirements.txt) and
+# falls back to asyncio/h11 on platforms without them (uvloop has no Windows build)
+print(f"Starting Uvicorn on 0.0.0.0:{PORT} with {WORKERS} worker(s)")
+uvicorn.run("app:app", host="0.0.0.0", port=PORT, loop="auto", http="auto",
+            workers=WORKERS, log_level="info")
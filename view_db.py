@@ -2,6 +2,9 @@
 import sqlite3
 conn = sqlite3.connect("triagesense.db")
 cur = conn.cursor()
-for row in cur.execute("SELECT id, symptoms, created_at FROM submissions ORDER BY id DESC LIMIT 20"):
-    print(row)
+cur.arraysize = 500
+cur.execute("SELECT id, symptoms, created_at FROM submissions ORDER BY id DESC LIMIT 20")
+while (rows := cur.fetchmany()):
+    for row in rows:
+        print(row)
 conn.close()